@@ -4,10 +4,260 @@ import os
 import logging
 import logging.handlers
 import argparse
+import asyncio
+import contextlib
 import fnmatch
-from agithub.GitHub import GitHub
+import http
+import io
+import re
+import shelve
+import sys
+import time
+import aiohttp
+import gidgethub.sansio
+import orjson
+from collections.abc import MutableMapping
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from statistics import fmean
+from gidgethub import (
+    BadGraphQLRequest,
+    GitHubBroken,
+    GitHubException,
+    RateLimitExceeded,
+)
+from gidgethub.aiohttp import GitHubAPI
+from gidgethub.sansio import RateLimit
 from dotenv import load_dotenv
 
+# gidgethub decodes every response with the stdlib json module - orjson parses the
+# large workflow run pages several times faster
+gidgethub.sansio.json = orjson
+
+# Largest page size the Github REST API allows for list endpoints
+PER_PAGE = 100
+
+# Once fewer requests than this remain, hold off until the rate limit resets
+RATE_LIMIT_THRESHOLD = 50
+
+# How many times a rate limited or failed request is retried before giving up
+MAX_RETRIES = 5
+
+# Longest we back off for between retries of a request that failed on Github's side
+MAX_BACKOFF_SECS = 60
+
+# The org's repos and their workflows change on a scale of days, so a listing fetched
+# within this long is reused without asking Github at all
+DISCOVERY_CACHE_TTL_SECS = 24 * 60 * 60
+
+# Cached responses that haven't been used in this long are dropped from the cache file
+CACHE_MAX_AGE_SECS = 7 * 24 * 60 * 60
+
+# Cache entry recording when every other entry was last read or written
+CACHE_LAST_USED_KEY = "last-used"
+
+# Possible states: success, failure, cancelled, skipped, timed_out, action_required, neutral
+WORKFLOW_SUCCESS_STATES = frozenset(
+    ["success", "neutral", "cancelled", "skipped", "action_required"]
+)
+WORKFLOW_FAILURE_STATES = frozenset(["failure", "timed_out"])
+
+GRAPHQL_URL = "https://api.github.com/graphql"
+
+# Archived repos are filtered out by Github rather than coming down the wire for us to skip
+REPOS_QUERY = """
+query ($org: String!, $first: Int!, $cursor: String) {
+  organization(login: $org) {
+    repositories(
+      first: $first
+      after: $cursor
+      isArchived: false
+      orderBy: { field: CREATED_AT, direction: DESC }
+    ) {
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+      nodes {
+        name
+        isEmpty
+      }
+    }
+  }
+}
+"""
+
+
+class RateLimitedGitHubAPI(GitHubAPI):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # GraphQL queries are counted against their own rate limit, separate from REST
+        self.rest_rate_limit = None
+        self.graphql_rate_limit = None
+
+    async def _request(self, method, url, headers, body=b""):
+        attempt = 1
+
+        # Dropped connections and timeouts aren't HTTP errors, so gidgethub never offers
+        # them to handle_rate_limit_error - retry them here with the same backoff
+        while True:
+            try:
+                response = await super()._request(method, url, headers, body)
+                break
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as exc:
+                if attempt > MAX_RETRIES:
+                    raise
+
+                delay = min(2 ** (attempt - 1), MAX_BACKOFF_SECS)
+                logger.warning(
+                    "Request to {} failed ({!r}) - retrying in {:.0f}s".format(
+                        url, exc, delay
+                    )
+                )
+                await self.sleep(delay)
+                attempt += 1
+
+        status_code, response_headers, _ = response
+
+        # gidgethub only reads the rate limit off responses it decodes, so cached (304)
+        # responses would otherwise leave it counting down without ever being corrected
+        rate_limit = RateLimit.from_http(response_headers)
+        if rate_limit is not None:
+            if is_graphql_url(url):
+                self.graphql_rate_limit = rate_limit
+            else:
+                self.rest_rate_limit = rate_limit
+
+        # A 5xx from the GraphQL endpoint often isn't JSON, which gidgethub reports as a
+        # content-type error - raise it as the Github failure it is so it can be retried
+        if is_graphql_url(url) and status_code >= 500:
+            raise GitHubBroken(http.HTTPStatus(status_code), headers=response_headers)
+
+        return response
+
+    async def graphql(self, query, *, endpoint=GRAPHQL_URL, **variables):
+        # gidgethub sends GraphQL queries straight to _request, so run them through the
+        # same rate limit handling and retries as our REST requests
+        attempt = 1
+
+        while True:
+            await self.manage_rate_limit(method="POST", url=endpoint)
+
+            try:
+                return await super().graphql(query, endpoint=endpoint, **variables)
+            except (GitHubBroken, BadGraphQLRequest) as exc:
+                if not await self.handle_rate_limit_error(
+                    method="POST", url=endpoint, exception=exc, attempt=attempt
+                ):
+                    raise
+
+            attempt += 1
+
+    async def manage_rate_limit(self, *, method, url):
+        if is_graphql_url(url):
+            rate_limit = self.graphql_rate_limit
+        else:
+            rate_limit = self.rest_rate_limit
+
+        # Wait for the reset rather than have every request in flight rejected
+        if rate_limit is not None and rate_limit.remaining < RATE_LIMIT_THRESHOLD:
+            delay = get_secs_until(rate_limit.reset_datetime)
+
+            if delay > 0:
+                logger.warning(
+                    "Only {} Github API requests left - waiting {:.0f}s for the rate limit to reset".format(
+                        rate_limit.remaining, delay
+                    )
+                )
+                await self.sleep(delay)
+
+    async def handle_rate_limit_error(self, *, method, url, exception, attempt):
+        if attempt > MAX_RETRIES:
+            return False
+
+        # GraphQL errors don't carry the response headers
+        headers = getattr(exception, "headers", {})
+
+        if "retry-after" in headers:
+            delay = int(headers["retry-after"])
+        elif isinstance(exception, RateLimitExceeded):
+            delay = get_secs_until(exception.rate_limit.reset_datetime)
+        elif exception.status_code in (403, 429) and "secondary rate limit" in str(
+            exception
+        ):
+            # Github asks for at least a minute between retries when it doesn't say how long
+            delay = 60
+        elif exception.status_code in (429, 502, 503, 504):
+            # Transient failure - back off exponentially
+            delay = min(2 ** (attempt - 1), MAX_BACKOFF_SECS)
+        else:
+            return False
+
+        logger.warning(
+            "Github returned {} - retrying {} in {:.0f}s".format(
+                exception.status_code, url, delay
+            )
+        )
+        await self.sleep(max(delay, 0))
+
+        return True
+
+
+class ResponseCache(MutableMapping):
+    # Keeps track of when each cached response was last used. gidgethub reads but never
+    # rewrites an entry on a 304, so this is held in memory and saved once at the end
+    def __init__(self, shelf):
+        self.shelf = shelf
+        self.last_used = shelf.get(CACHE_LAST_USED_KEY, {})
+
+    def __getitem__(self, key):
+        value = self.shelf[key]
+        self.last_used[key] = time.time()
+
+        return value
+
+    def __setitem__(self, key, value):
+        self.shelf[key] = value
+        self.last_used[key] = time.time()
+
+    def __delitem__(self, key):
+        del self.shelf[key]
+        self.last_used.pop(key, None)
+
+    def __iter__(self):
+        return iter(self.last_used)
+
+    def __len__(self):
+        return len(self.last_used)
+
+    def save(self):
+        self.shelf[CACHE_LAST_USED_KEY] = self.last_used
+
+
+@dataclass(slots=True)
+class WorkflowStat:
+    repo: str
+    workflow: str
+    total_runs: int
+    success_count: int
+    fail_count: int
+    success_rate: float
+    fail_rate: float
+    avg_duration_ms: float
+
+
+def positive_int(value):
+    try:
+        int_val = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid int value: {!r}".format(value))
+
+    if int_val < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+
+    return int_val
+
 
 def get_mins_secs_str(duration_in_ms):
     duration_secs, duration_in_ms = divmod(duration_in_ms, 1000)
@@ -16,6 +266,14 @@ def get_mins_secs_str(duration_in_ms):
     return str(round(duration_mins)) + "m " + str(round(duration_secs)) + "s"
 
 
+def is_graphql_url(url):
+    return url.endswith("/graphql")
+
+
+def get_secs_until(reset_datetime):
+    return (reset_datetime - datetime.now(timezone.utc)).total_seconds()
+
+
 def format_number(float_val):
     if float_val.is_integer():
         return_val = int(float_val)
@@ -25,24 +283,36 @@ def format_number(float_val):
     return str(return_val)
 
 
-def get_workflow_runs(org_name, repo_name, workflow_id, date_filter):
-    # Pagination does not work on this call
-    # https://github.com/mozilla/agithub/issues/76
-
-    runs = []
+async def iter_workflow_runs(gh, org_name, repo_name, workflow_id, date_filter):
+    # Yield runs as each page arrives so callers never hold more than one page in memory
     total_runs_returned = 0
     page_to_get = 1
     more_results = True
 
+    # Only the page number changes from one request to the next
+    url_vars = {
+        "org": org_name,
+        "repo": repo_name,
+        "workflow_id": workflow_id,
+        "created": date_filter,
+        # Runs still queued or in progress have no conclusion or final duration yet
+        "status": "completed",
+        # We never look at the pull requests attached to each run, so leave them out of the response
+        "exclude_pull_requests": "true",
+        "per_page": PER_PAGE,
+    }
+
     while more_results:
+        url_vars["page"] = page_to_get
+
         # repos/{org}}/{repo name}/actions/workflows/{workflow id}/runs
-        gh_status, workflow_runs = (
-            github_handle.repos[org_name][repo_name]
-            .actions.workflows[workflow_id]
-            .runs.get(created=date_filter, page=page_to_get)
+        workflow_runs = await gh.getitem(
+            "/repos/{org}/{repo}/actions/workflows/{workflow_id}/runs{?created,status,exclude_pull_requests,page,per_page}",
+            url_vars,
         )
 
-        runs = runs + workflow_runs["workflow_runs"]
+        for workflow_run in workflow_runs["workflow_runs"]:
+            yield workflow_run
 
         total_runs = workflow_runs["total_count"]
         runs_returned_in_this_page = len(workflow_runs["workflow_runs"])
@@ -54,7 +324,8 @@ def get_workflow_runs(org_name, repo_name, workflow_id, date_filter):
             )
         )
 
-        if total_runs_returned < total_runs:
+        # A short page is the last one, so no need to ask for another
+        if runs_returned_in_this_page == PER_PAGE and total_runs_returned < total_runs:
             page_to_get += 1
             logger.debug(
                 "We have more runs to get - now getting page {}".format(page_to_get)
@@ -63,266 +334,344 @@ def get_workflow_runs(org_name, repo_name, workflow_id, date_filter):
             logger.debug("All runs retrieved")
             more_results = False
 
-    return runs
 
+async def get_with_ttl(cache, key, fetch, refresh=False):
+    try:
+        fetched_at, data = cache[key]
+    except KeyError:
+        pass
+    else:
+        if not refresh and time.time() - fetched_at < DISCOVERY_CACHE_TTL_SECS:
+            logger.debug("Using cached {}".format(key))
+            return data
 
-if __name__ == "__main__":
-    summary_stats = dict()
+    data = await fetch()
+    cache[key] = time.time(), data
 
-    description = "Gather deployment metrics from Github actions\n"
+    return data
 
-    parser = argparse.ArgumentParser(
-        description=description, formatter_class=argparse.RawTextHelpFormatter
-    )
 
-    parser.add_argument(
-        "--org-name", help="Github organization name", dest="org_name", required=True
-    )
-    parser.add_argument(
-        "--deploy-workflow-pattern",
-        help="Track stats for all jobs run matching this workflow name pattern (eg. *Deploy*)",
-        dest="workflow_pattern",
-        required=True,
-    )
-    parser.add_argument(
-        "--date-filter",
-        help="Github start/end date filter (eg. 2023-03-01..2023-03-31)",
-        dest="date_filter",
-        required=True,
-    )
-    parser.add_argument(
-        "--detailed", help="Show detailed output for each repo", action="store_true"
-    )
-    parser.add_argument(
-        "--include-manual-runs",
-        help="Include manual workflow runs in stats computations",
-        dest="include_manual_runs",
-        action="store_true",
+async def list_repos(gh, org_name):
+    repos = []
+    cursor = None
+    more_results = True
+
+    while more_results:
+        repo_data = await gh.graphql(
+            REPOS_QUERY, org=org_name, first=PER_PAGE, cursor=cursor
+        )
+        repositories = repo_data["organization"]["repositories"]
+
+        repos.extend(repositories["nodes"])
+
+        cursor = repositories["pageInfo"]["endCursor"]
+        more_results = repositories["pageInfo"]["hasNextPage"]
+
+    return repos
+
+
+async def list_workflows(gh, sem, org_name, repo_name):
+    # /repos/{org}/{repo name}/actions/workflows
+    async with sem:
+        return [
+            workflow
+            async for workflow in gh.getiter(
+                "/repos/{org}/{repo}/actions/workflows{?per_page}",
+                {"org": org_name, "repo": repo_name, "per_page": PER_PAGE},
+                iterable_key="workflows",
+            )
+        ]
+
+
+def get_run_duration_ms(workflow_run):
+    # Some jobs may not have run at all
+    if workflow_run["run_started_at"] is None or workflow_run["updated_at"] is None:
+        return 0
+
+    run_started_at = datetime.fromisoformat(
+        workflow_run["run_started_at"].replace("Z", "+00:00")
     )
-    parser.add_argument(
-        "--verbose", help="Turn on DEBUG logging", action="store_true", required=False
+    run_updated_at = datetime.fromisoformat(
+        workflow_run["updated_at"].replace("Z", "+00:00")
     )
 
-    args = parser.parse_args()
+    return int((run_updated_at - run_started_at).total_seconds() * 1000)
 
-    log_level = logging.INFO
 
-    if args.verbose:
-        print("Verbose logging selected")
-        log_level = logging.DEBUG
+@contextlib.contextmanager
+def open_cache(filename):
+    # The cache holds private org data, so keep it readable by the current user only
+    old_umask = os.umask(0o077)
 
-    # Setup some logging
-    logger = logging.getLogger()
-    logger.setLevel(log_level)
-    ch = logging.StreamHandler()
-    ch.setLevel(log_level)
-    console_formatter = logging.Formatter("%(levelname)8s: %(message)s")
-    ch.setFormatter(console_formatter)
-    logger.addHandler(ch)
+    try:
+        with shelve.open(filename) as shelf:
+            last_used = shelf.get(CACHE_LAST_USED_KEY, {})
+            cutoff = time.time() - CACHE_MAX_AGE_SECS
+            fresh_keys = [
+                key
+                for key, used_at in last_used.items()
+                if used_at >= cutoff and key in shelf
+            ]
+            # Anything the last-used entry doesn't know about is stale as well
+            stale_count = len(shelf) - len(fresh_keys) - (CACHE_LAST_USED_KEY in shelf)
 
-    load_dotenv()
+            if stale_count > 0:
+                fresh_entries = {key: shelf[key] for key in fresh_keys}
 
-    if "GITHUB_PAT" in os.environ:
-        logger.debug("Found GITHUB_PAT in the envrionment")
-        github_pat = os.getenv("GITHUB_PAT")
-    else:
-        logger.error("Missing GITHUB_PAT environment variable - unable to continue")
-        exit(1)
+        # dbm files never give back the space of deleted entries, so rather than deleting
+        # the stale ones in place, the fresh ones are copied into a brand new file
+        if stale_count > 0:
+            logger.debug("Dropping {} stale cache entries".format(stale_count))
 
-    # Initialize connection to Github API
-    github_handle = GitHub(token=github_pat, paginate=True)
+            with shelve.open(filename, flag="n") as shelf:
+                for key, value in fresh_entries.items():
+                    shelf[key] = value
 
-    # Get all the repos in the org
-    # /orgs/{org}/repos
-    gh_status, repo_data = github_handle.orgs[args.org_name].repos.get()
+                shelf[CACHE_LAST_USED_KEY] = {
+                    key: last_used[key] for key in fresh_entries
+                }
 
-    for repo in repo_data:
-        repo_name = repo["name"]
-        repo_printed = False
+        shelf = shelve.open(filename)
+    finally:
+        os.umask(old_umask)
 
-        logger.debug("Processing repo {}".format(repo_name))
+    cache = ResponseCache(shelf)
 
-        if repo["archived"]:
-            logger.debug("repo {} is archived - skipping".format(repo_name))
-            continue
+    try:
+        yield cache
+    finally:
+        cache.save()
+        shelf.close()
 
-        # Now for each repo, see if we have a deployment workflow matching the pattern
-        # /repos/{org}/{repo name}/actions/workflows
-        gh_status, workflow_data = github_handle.repos[args.org_name][
-            repo_name
-        ].actions.workflows.get()
 
-        for workflow in workflow_data["workflows"]:
-            # Possible states: success, failure, cancelled, skipped, timed_out, action_required, neutral
+async def get_workflow_stat(gh, sem, args, repo_name, workflow):
+    async with sem:
+        org_name = args.org_name
+        include_manual_runs = args.include_manual_runs
 
-            workflow_runs = []
-            workflow_success_count = 0
-            workflow_success_rate = 100
-            workflow_success_states = set(
-                ["success", "neutral", "cancelled", "skipped", "action_required"]
-            )
+        workflow_success_count = 0
+        workflow_fail_count = 0
 
-            workflow_fail_count = 0
-            workflow_failure_rate = 0
-            workflow_failure_states = set(["failure", "timed_out"])
+        workflow_total_duration = 0
 
-            workflow_avg_duration = 0
-            workflow_total_duration = 0
+        workflow_id = workflow["id"]
+        workflow_name = workflow["name"]
 
-            workflow_id = workflow["id"]
-            workflow_name = workflow["name"]
-            workflow_summary_name = workflow_name.replace(
-                " ", ""
-            )  # Dicts cannot have spaces in keys
+        total_workflow_runs = 0
+        runs_found = 0
 
-            logging.debug("Found workflow {}".format(workflow_name))
+        # We have a matching workflow - tally the runs for it in our timeframe as they arrive
+        async for workflow_run in iter_workflow_runs(
+            gh, org_name, repo_name, workflow_id, args.date_filter
+        ):
+            workflow_status = workflow_run["conclusion"]
+            job_id = workflow_run["id"]
+            runs_found += 1
 
-            if fnmatch.fnmatch(workflow_name, args.workflow_pattern):
-                logging.debug(
-                    "workflow {} matches {}".format(
-                        workflow_name, args.workflow_pattern
+            # Manual runs are generally used for testing so exclude them by default
+            if workflow_run["event"] == "workflow_dispatch":
+                if include_manual_runs:
+                    logging.debug(
+                        "Workflow run {} was manually invoked and include-manual-runs is set - including in stats".format(
+                            job_id
+                        )
                     )
-                )
+                else:
+                    logging.debug(
+                        "Workflow run {} was manually invoked - excluding from stats".format(
+                            job_id
+                        )
+                    )
+                    continue
 
-                # We have a matching workflow - get the runs for it in our timeframe
-                workflow_runs = get_workflow_runs(
-                    args.org_name, repo_name, workflow_id, args.date_filter
-                )
+            total_workflow_runs += 1
 
-                total_workflow_runs = len(workflow_runs)
+            logging.debug(
+                "Workflow status for {} is {}".format(workflow_name, workflow_status)
+            )
 
-                logging.debug(
-                    "Found {} workflow runs for {}".format(
-                        total_workflow_runs, workflow_name
-                    )
+            # Get the success/fail status of these runs
+            if workflow_status in WORKFLOW_SUCCESS_STATES:
+                workflow_success_count += 1
+            elif workflow_status in WORKFLOW_FAILURE_STATES:
+                workflow_fail_count += 1
+
+            # How long did this run run for
+            job_duration = get_run_duration_ms(workflow_run)
+            workflow_total_duration += job_duration
+
+            logging.debug(
+                "Job {} ran for {} ms and ended with status {}".format(
+                    job_id, job_duration, workflow_status
                 )
+            )
 
-                # Were there any runs for this workflow in this time period?
-                if total_workflow_runs > 0:
-                    if args.detailed and not repo_printed:
-                        print("{}".format(repo_name))
-                        repo_printed = True
-
-                    # Initialize our summary stats dict
-                    if repo_name not in summary_stats:
-                        summary_stats[repo_name] = dict()
-
-                    for workflow_run in workflow_runs:
-                        workflow_status = workflow_run["conclusion"]
-                        job_id = workflow_run["id"]
-
-                        # Manual runs are generally used for testing so exclude them by default
-                        if workflow_run["event"] == "workflow_dispatch":
-                            if args.include_manual_runs:
-                                logging.debug(
-                                    "Workflow run {} was manually invoked and include-manual-runs is set - including in stats".format(
-                                        job_id
-                                    )
-                                )
-                            else:
-                                logging.debug(
-                                    "Workflow run {} was manually invoked - excluding from stats".format(
-                                        job_id
-                                    )
-                                )
-                                total_workflow_runs -= 1
-                                continue
-
-                        logging.debug(
-                            "Workflow status for {} is {}".format(
-                                workflow_name, workflow_status
-                            )
-                        )
+        logging.debug("Found {} workflow runs for {}".format(runs_found, workflow_name))
 
-                        # Get the success/fail status of these runs
-                        if workflow_status in workflow_success_states:
-                            workflow_success_count += 1
-                        elif workflow_status in workflow_failure_states:
-                            workflow_fail_count += 1
-
-                        # How long did this run run for
-                        # repos/{org}/{repo}/actions/runs/{run id}/timing
-                        gh_status, workflow_durations = (
-                            github_handle.repos[args.org_name][repo_name]
-                            .actions.runs[job_id]
-                            .timing.get()
-                        )
+        # Were there any runs for this workflow in this time period?
+        if runs_found == 0:
+            return None
 
-                        # Some jobs may not have run at all
-                        if "run_duration_ms" in workflow_durations:
-                            job_duration = workflow_durations["run_duration_ms"]
-                        else:
-                            job_duration = 0
+        # Because we are only counting non-manual runs, we could have 0 actual "runs"
+        # This causes a dividie by zero error
+        if total_workflow_runs == 0:
+            workflow_success_rate = 0.0
+            workflow_failure_rate = 0.0
+            workflow_avg_duration = 0.0
+        else:
+            workflow_success_rate = 100.0 * workflow_success_count / total_workflow_runs
+            workflow_failure_rate = 100.0 * workflow_fail_count / total_workflow_runs
+            workflow_avg_duration = workflow_total_duration / total_workflow_runs
+
+        # Assemble our stats record for this workflow in this repo
+        return WorkflowStat(
+            repo=repo_name,
+            workflow=workflow_name,
+            total_runs=total_workflow_runs,
+            success_count=workflow_success_count,
+            fail_count=workflow_fail_count,
+            success_rate=workflow_success_rate,
+            fail_rate=workflow_failure_rate,
+            avg_duration_ms=workflow_avg_duration,
+        )
 
-                        workflow_total_duration += job_duration
 
-                        logging.debug(
-                            "Job {} ran for {} ms and ended with status {}".format(
-                                job_id, job_duration, workflow_status
-                            )
-                        )
+async def process_repo(gh, sem, cache, args, workflow_re, repo):
+    repo_name = repo["name"]
+    matching_workflows = []
 
-                    # Because we are only counting non-manual runs, we could have 0 actual "runs"
-                    # This causes a dividie by zero error
-                    if total_workflow_runs == 0:
-                        workflow_success_rate = 0
-                        workflow_failure_rate = 0
-                        workflow_avg_duration = 0
-                    else:
-                        # Assemble our stats record for this workflow in this repo
-                        workflow_success_rate = format_number(
-                            100.0 * workflow_success_count / total_workflow_runs
-                        )
-                        workflow_failure_rate = format_number(
-                            100.0 * workflow_fail_count / total_workflow_runs
-                        )
-                        workflow_avg_duration = float(workflow_total_duration) / float(
-                            total_workflow_runs
-                        )
+    logger.debug("Processing repo {}".format(repo_name))
 
-                    stat = {
-                        "total_runs": total_workflow_runs,
-                        "success_count": workflow_success_count,
-                        "fail_count": workflow_fail_count,
-                        "success_rate": workflow_success_rate,
-                        "fail_rate": workflow_failure_rate,
-                        "avg_duration_ms": workflow_avg_duration,
-                    }
-                    summary_stats[repo_name][workflow_summary_name] = stat
-
-                    if args.detailed:
-                        print("\t{}:".format(workflow_name))
-                        print("\t\tRuns: {}".format(total_workflow_runs))
-                        print("\t\tSuccessful: {}".format(workflow_success_count))
-                        print("\t\tFailed: {}".format(workflow_fail_count))
-                        print("\t\tSuccess Rate: {}%".format(workflow_success_rate))
-                        print(
-                            "\t\tAvg Duration:: {:.0f} ms ({})".format(
-                                workflow_avg_duration,
-                                get_mins_secs_str(workflow_avg_duration),
-                            )
-                        )
+    # Now for each repo, see if we have a deployment workflow matching the pattern
+    workflow_data = await get_with_ttl(
+        cache,
+        "workflows:{}/{}".format(args.org_name, repo_name),
+        lambda: list_workflows(gh, sem, args.org_name, repo_name),
+        refresh=args.refresh_discovery,
+    )
 
-    # now we can process the stats we have gathered and get the overall averages
-    workflow_count = 0
-    overall_success_sum = 0
-    overall_failure_sum = 0
-    overall_duration_ms_sum = 0
-    overall_run_count = 0
-
-    for stat_repo in summary_stats:
-        for stat_workflow in summary_stats[stat_repo]:
-            workflow_count += 1
-            overall_success_sum += float(
-                summary_stats[stat_repo][stat_workflow]["success_rate"]
+    for workflow in workflow_data:
+        logging.debug("Found workflow {}".format(workflow["name"]))
+
+        if workflow_re.match(workflow["name"]):
+            logging.debug(
+                "workflow {} matches {}".format(workflow["name"], args.workflow_pattern)
             )
-            overall_failure_sum += float(
-                summary_stats[stat_repo][stat_workflow]["fail_rate"]
+            matching_workflows.append(workflow)
+
+    # Tally the runs for every matching workflow at the same time
+    tasks = [
+        asyncio.create_task(get_workflow_stat(gh, sem, args, repo_name, workflow))
+        for workflow in matching_workflows
+    ]
+
+    try:
+        workflow_stats = await asyncio.gather(*tasks)
+    except BaseException:
+        # One failed workflow fails the whole repo, so stop paging through the others
+        for task in tasks:
+            task.cancel()
+        raise
+
+    return [stat for stat in workflow_stats if stat is not None]
+
+
+async def main(args, github_pat, cache):
+    stats = []
+    excluded_repos = []
+
+    # Every request shares one pool of keep-alive connections, so only the first request on
+    # each connection pays for the TLS handshake. The pool matches --concurrency - the
+    # total limit has to be set too, as aiohttp otherwise caps it at 100
+    connector = aiohttp.TCPConnector(
+        limit=args.concurrency, limit_per_host=args.concurrency
+    )
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        # Initialize connection to Github API
+        gh = RateLimitedGitHubAPI(
+            session, "deploy-metrics", oauth_token=github_pat, cache=cache
+        )
+
+        # Get all the non-archived repos in the org
+        repo_data = []
+
+        for repo in await get_with_ttl(
+            cache,
+            "repos:{}".format(args.org_name),
+            lambda: list_repos(gh, args.org_name),
+            refresh=args.refresh_discovery,
+        ):
+            # An empty repo cannot have any workflows, so don't bother asking
+            if repo["isEmpty"]:
+                logger.debug("repo {} is empty - skipping".format(repo["name"]))
+            else:
+                repo_data.append(repo)
+
+        # Bound the number of listings fetched at once to stay under Github's secondary rate limits
+        sem = asyncio.Semaphore(args.concurrency)
+
+        # Compile the workflow pattern once rather than on every workflow we check
+        workflow_re = re.compile(fnmatch.translate(args.workflow_pattern))
+
+        repo_stats = await asyncio.gather(
+            *[
+                process_repo(gh, sem, cache, args, workflow_re, repo)
+                for repo in repo_data
+            ],
+            return_exceptions=True,
+        )
+
+    # Collect the detailed output and write it out in one go
+    detailed_output = io.StringIO()
+
+    for repo, workflow_stats in zip(repo_data, repo_stats):
+        # A repo that is still failing after our retries shouldn't throw away the stats
+        # gathered for every other repo
+        if isinstance(
+            workflow_stats,
+            (GitHubException, aiohttp.ClientError, asyncio.TimeoutError),
+        ):
+            logger.error(
+                "Unable to gather stats for repo {} - excluding it: {!r}".format(
+                    repo["name"], workflow_stats
+                )
             )
-            overall_duration_ms_sum += summary_stats[stat_repo][stat_workflow][
-                "avg_duration_ms"
-            ]
-            overall_run_count += summary_stats[stat_repo][stat_workflow]["total_runs"]
+            excluded_repos.append(repo["name"])
+            continue
+        elif isinstance(workflow_stats, BaseException):
+            raise workflow_stats
+
+        if len(workflow_stats) == 0:
+            continue
+
+        stats.extend(workflow_stats)
+
+        if args.detailed:
+            detailed_output.write("{}\n".format(repo["name"]))
+
+            for stat in workflow_stats:
+                detailed_output.write(
+                    "\t{}:\n"
+                    "\t\tRuns: {}\n"
+                    "\t\tSuccessful: {}\n"
+                    "\t\tFailed: {}\n"
+                    "\t\tSuccess Rate: {}%\n"
+                    "\t\tAvg Duration:: {:.0f} ms ({})\n".format(
+                        stat.workflow,
+                        stat.total_runs,
+                        stat.success_count,
+                        stat.fail_count,
+                        format_number(stat.success_rate),
+                        stat.avg_duration_ms,
+                        get_mins_secs_str(stat.avg_duration_ms),
+                    )
+                )
+
+    sys.stdout.write(detailed_output.getvalue())
+
+    # now we can process the stats we have gathered and get the overall averages
+    workflow_count = len(stats)
 
     print("\n")
     print("-------- SUMMARY ---------")
@@ -334,13 +683,14 @@ if __name__ == "__main__":
 
     if workflow_count != 0:
         # Finally grab the overall averages
+        overall_run_count = sum(stat.total_runs for stat in stats)
         overall_average_success_rate = format_number(
-            overall_success_sum / workflow_count
+            fmean(stat.success_rate for stat in stats)
         )
         overall_average_failure_rate = format_number(
-            overall_failure_sum / workflow_count
+            fmean(stat.fail_rate for stat in stats)
         )
-        overall_average_duration_ms = overall_duration_ms_sum / workflow_count
+        overall_average_duration_ms = fmean(stat.avg_duration_ms for stat in stats)
 
         print("Total Runs: {}".format(overall_run_count))
         print("Avg Success Rate: {}%".format(overall_average_success_rate))
@@ -353,3 +703,98 @@ if __name__ == "__main__":
         )
     else:
         print("No workflows found matching the filter and/or date critiera")
+
+    # Make it clear the numbers above are missing some repos
+    if excluded_repos:
+        print("Excluded repos (errors): {}".format(", ".join(excluded_repos)))
+
+    return excluded_repos
+
+
+if __name__ == "__main__":
+    description = "Gather deployment metrics from Github actions\n"
+
+    parser = argparse.ArgumentParser(
+        description=description, formatter_class=argparse.RawTextHelpFormatter
+    )
+
+    parser.add_argument(
+        "--org-name", help="Github organization name", dest="org_name", required=True
+    )
+    parser.add_argument(
+        "--deploy-workflow-pattern",
+        help="Track stats for all jobs run matching this workflow name pattern (eg. *Deploy*)",
+        dest="workflow_pattern",
+        required=True,
+    )
+    parser.add_argument(
+        "--date-filter",
+        help="Github start/end date filter (eg. 2023-03-01..2023-03-31)",
+        dest="date_filter",
+        required=True,
+    )
+    parser.add_argument(
+        "--detailed", help="Show detailed output for each repo", action="store_true"
+    )
+    parser.add_argument(
+        "--include-manual-runs",
+        help="Include manual workflow runs in stats computations",
+        dest="include_manual_runs",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--concurrency",
+        help="Maximum number of Github API listings to fetch at once (default: 10)",
+        type=positive_int,
+        default=10,
+    )
+    parser.add_argument(
+        "--cache-file",
+        help="File used to cache Github API responses between runs (default: .gh-cache)",
+        dest="cache_file",
+        default=".gh-cache",
+    )
+    parser.add_argument(
+        "--refresh-discovery",
+        help="Look up the org's repos and workflows again even if they were cached in the last 24 hours",
+        dest="refresh_discovery",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--verbose", help="Turn on DEBUG logging", action="store_true", required=False
+    )
+
+    args = parser.parse_args()
+
+    log_level = logging.INFO
+
+    if args.verbose:
+        print("Verbose logging selected")
+        log_level = logging.DEBUG
+
+    # Setup some logging
+    logger = logging.getLogger()
+    logger.setLevel(log_level)
+    ch = logging.StreamHandler()
+    ch.setLevel(log_level)
+    console_formatter = logging.Formatter("%(levelname)8s: %(message)s")
+    ch.setFormatter(console_formatter)
+    logger.addHandler(ch)
+
+    load_dotenv()
+
+    if "GITHUB_PAT" in os.environ:
+        logger.debug("Found GITHUB_PAT in the envrionment")
+        github_pat = os.getenv("GITHUB_PAT")
+    else:
+        logger.error("Missing GITHUB_PAT environment variable - unable to continue")
+        exit(1)
+
+    # Responses are kept on disk along with their ETag so repeat runs make conditional
+    # requests - a 304 Not Modified does not count against the Github rate limit
+    with open_cache(args.cache_file) as cache:
+        excluded_repos = asyncio.run(main(args, github_pat, cache))
+
+    # Partial stats shouldn't pass for a clean run
+    if excluded_repos:
+        exit(1)